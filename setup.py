@@ -34,7 +34,9 @@ setup(
     keywords='trello bugzilla',
     packages=find_packages(),
     install_requires=[
+        'httpx[http2]==0.27.0',
         'oauthlib==2.0.1',
+        'orjson==3.10.3',
         'py-trello==0.9.0',
         'python-dateutil==2.6.0',
         'pytz==2016.10',
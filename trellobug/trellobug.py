@@ -1,21 +1,23 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import asyncio
 import configparser
-import json
+import functools
+import hashlib
+import io
+import os
 import os.path
 import re
-import textwrap
-from urllib.error import HTTPError
-from urllib.parse import urlparse
-from urllib.request import (
-    Request,
-    urlopen,
+from collections import namedtuple
+from datetime import (
+    datetime,
+    timedelta,
 )
+from urllib.parse import urlparse
 
-from trello import TrelloClient
-from trello.exceptions import Unauthorized
-from trello.util import create_oauth_token
+import httpx
+import orjson
 
 
 DEFAULT_BUGZILLA_URL = 'https://bugzilla.mozilla.org/'
@@ -27,42 +29,87 @@ DEFAULT_CONFIG_FILES = (
 DEFAULT_PRODUCT = 'Conduit'
 DEFAULT_VERSION = 'unspecified'
 
-card_path = re.compile('^/c/([^/]+)/')
-story_name_with_points = re.compile('\([\d]+\)[\s]*(.*)')
+MAX_ERROR_BODY_BYTES = 65536
+MAX_TRELLO_ATTEMPTS = 3
+
+TRELLO_TOKEN_LIFETIME = timedelta(days=30)
+TRELLO_TOKEN_REFRESH_MARGIN = timedelta(days=1)
+
+card_path = re.compile(r'^/c/([^/]+)/')
+story_name_with_points = re.compile(r'\(\d+\)\s*(.*)')
 
 bug_api_url_tmpl = '{}/rest/bug'
 bz_whoami_api_url_tmpl = '{}/rest/whoami'
 bug_url_tmpl = '{}/show_bug.cgi?id={}'
 card_api_url_tmpl = 'https://api.trello.com/1/cards/{}/'
 
+# The only card fields we ever look at; requesting just these keeps
+# Trello responses to a few hundred bytes instead of the full card.
+card_fields = 'name,desc,shortUrl'
+
+Card = namedtuple('Card', ['name', 'description', 'short_url'])
+
+card_cache_dir = os.path.expanduser('~/.cache/trellobug')
 
-def get_bugzilla_error(e):
-    error_body = e.read().decode('utf8')
-    error_dict = None
+
+def get_bugzilla_error(body):
+    # Proxies and middleboxes can return arbitrarily large error pages;
+    # don't parse or decode more than we would ever display.
+    if len(body) > MAX_ERROR_BODY_BYTES:
+        return body[:MAX_ERROR_BODY_BYTES].decode('utf8', 'replace')
 
     try:
-        error_dict = json.loads(error_body)
-    except json.decoder.JSONDecodeError:
-        return error_body
+        error_dict = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return body.decode('utf8', 'replace')
 
     return 'Error {}: {}'.format(error_dict['code'], error_dict['message'])
 
 
+@functools.lru_cache(maxsize=4)
+def _parse_config(config_file, mtime_ns):
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    return config
+
+
+def parse_config(config_file):
+    """Parse config_file, reusing a cached parse when it is unchanged.
+
+    The cache is keyed on the file's mtime, so edits (including our own
+    writes) invalidate it.  Callers get a fresh copy so their mutations
+    don't leak into the cache.
+    """
+    try:
+        mtime_ns = os.stat(config_file).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+
+    config = configparser.ConfigParser()
+    config.read_dict(_parse_config(config_file, mtime_ns))
+    return config
+
+
 def check_trello_tokens(func):
     """Decorator to handle expired Trello OAuth tokens.
 
-    Catches `Unauthorized` errors from trello and calls
-    self.handle_expired_trello_tokens().  It will retry forever until
-    successful.
+    Catches 401 errors from the Trello API and calls
+    self.handle_expired_trello_tokens().  Retries are bounded with
+    exponential backoff; a persistent 401 (e.g. a revoked API key)
+    propagates instead of re-prompting and rewriting the config file
+    forever.
     """
-    def func_wrapper(*args, **kwargs):
-        while True:
+    async def func_wrapper(*args, **kwargs):
+        for attempt in range(MAX_TRELLO_ATTEMPTS):
             try:
-                func(*args, **kwargs)
-                return
-            except Unauthorized:
+                return await func(*args, **kwargs)
+            except httpx.HTTPStatusError as e:
+                if (e.response.status_code != 401 or
+                        attempt == MAX_TRELLO_ATTEMPTS - 1):
+                    raise
                 print('Unauthorized!')
                 args[0].handle_expired_trello_tokens()
+                await asyncio.sleep(2 ** attempt)
     return func_wrapper
 
 
@@ -77,14 +124,65 @@ class TrelloBug(object):
         self.config = None
         self.bz_config = None
         self.trello_config = None
+        self.client = None
         self.load_config()
-        self.load_trello()
 
-    @check_trello_tokens
-    def trello_to_bug(self, card_id, assign_bug=False):
-        card = self.trello.get_card(card_id)
+        # These fields are the same for every bug filed in a run, so
+        # resolve the config/command-line fallbacks just once.
+        self._base_bug_data = {
+            'product': self.bz_product,
+            'component': self.bz_component,
+            'version': self.bz_version,
+            'op_sys': 'Unspecified',
+            'platform': 'Unspecified',
+        }
+
+    async def run(self, card_ids, assign_bug=False):
+        # A single client keeps connections to both Bugzilla and Trello
+        # alive, so repeated calls skip the TCP/TLS handshakes; with
+        # HTTP/2 concurrent requests multiplex over one connection.
+        async with httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=20),
+                timeout=30.0,
+                headers={
+                    'Accept': 'application/json',
+                    'Content-type': 'application/json',
+                }) as client:
+            self.client = client
 
-        bug = self.file_trello_bug(card, assign_bug)
+            # The whoami lookup doesn't depend on any card, so let it
+            # overlap with the card fetches.
+            user_task = None
+
+            if assign_bug:
+                user_task = asyncio.create_task(self.get_current_user())
+
+            results = await asyncio.gather(
+                *[self.process_card(card_id, user_task)
+                  for card_id in card_ids]
+            )
+
+        return all(results)
+
+    async def process_card(self, card_id, user_task=None):
+        """Fetch a card, file its bug and update its description.
+
+        Each card runs as its own pipeline, so one card's Trello update
+        overlaps with other cards' Bugzilla requests; only steps that
+        depend on each other run sequentially.
+        """
+        card = await self.get_card(card_id)
+
+        current_user = None
+
+        if user_task is not None:
+            current_user = await user_task
+
+            if not current_user:
+                return False
+
+        bug = await self.file_trello_bug(card, current_user)
 
         if not bug:
             return False
@@ -92,12 +190,15 @@ class TrelloBug(object):
         print('Bug {} <{}> filed:'.format(bug['id'], bug['url']))
         print('    {}'.format(bug['summary']))
 
-        card.set_description('{}\n\n{}'.format(bug['url'],
-                                               card.description))
-
-        print ('Card {} updated.'.format(card.short_url))
+        await self.update_card(card_id, card, bug)
         return True
 
+    async def update_card(self, card_id, card, bug):
+        await self.set_card_description(
+            card_id, '{}\n\n{}'.format(bug['url'], card.description))
+
+        print('Card {} updated.'.format(card.short_url))
+
     @property
     def bugzilla_url_base(self):
         return self.bz_config.get('url', DEFAULT_BUGZILLA_URL).rstrip('/')
@@ -118,6 +219,8 @@ class TrelloBug(object):
                 self.bz_config.get('version', DEFAULT_VERSION))
 
     def query_option(self, section, option, desc, instructions):
+        import textwrap
+
         if option not in self.config[section]:
             val = None
             print('{} not found.'.format(desc))
@@ -139,13 +242,22 @@ class TrelloBug(object):
 
     @property
     def bugzilla_auth_request_headers(self):
+        return {'X-Bugzilla-API-Key': self.bz_config['api_key']}
+
+    @property
+    def trello_auth_params(self):
         return {
-            'Accept': 'application/json',
-            'Content-type': 'application/json',
-            'X-Bugzilla-API-Key': self.bz_config['api_key'],
+            'key': self.trello_config['api_key'],
+            'token': self.trello_config['oauth_token'],
         }
 
     def generate_trello_oauth_tokens(self):
+        # Only needed on first-time setup and token refresh; importing
+        # py-trello here keeps it off the common startup path.
+        import textwrap
+
+        from trello.util import create_oauth_token
+
         print('Press enter to generate.')
         input()
 
@@ -160,45 +272,110 @@ class TrelloBug(object):
         for opt in ('oauth_token', 'oauth_token_secret'):
             self.trello_config[opt] = access_token[opt]
 
+        expires_at = datetime.utcnow() + TRELLO_TOKEN_LIFETIME
+        self.trello_config['oauth_token_expires_at'] = expires_at.isoformat()
+
         print('\n'.join(textwrap.wrap(
             'Token generated.  It will expire in 30 days, after which this '
             'script will generate a new one.')))
 
-    def load_trello(self):
-        self.trello = TrelloClient(
-            api_key=self.trello_config['api_key'],
-            api_secret=self.trello_config['api_secret'],
-            token=self.trello_config['oauth_token'],
-            token_secret=self.trello_config['oauth_token_secret']
-        )
+    def trello_tokens_expiring_soon(self):
+        expires_at = self.trello_config.get('oauth_token_expires_at')
+
+        if expires_at is None:
+            # Token generated before we started recording expiry; we
+            # can't do better than reacting to a 401.
+            return False
+
+        return (datetime.fromisoformat(expires_at) - datetime.utcnow() <
+                TRELLO_TOKEN_REFRESH_MARGIN)
 
     def handle_expired_trello_tokens(self):
         print('Trello OAuth token invalid or expired.')
         self.generate_trello_oauth_tokens()
         self.write_config()
-        self.load_trello()
 
-    def get_current_user(self):
+    def card_cache_path(self, card_id):
+        return os.path.join(card_cache_dir, card_id)
+
+    def load_cached_card(self, card_id):
+        try:
+            with open(self.card_cache_path(card_id), 'rb') as f:
+                entry = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return None, None
+
+        return entry.get('etag'), entry.get('card')
+
+    def store_cached_card(self, card_id, etag, data):
+        try:
+            os.makedirs(card_cache_dir, exist_ok=True)
+            with open(self.card_cache_path(card_id), 'wb') as f:
+                f.write(orjson.dumps({'etag': etag, 'card': data}))
+        except OSError:
+            # The cache is purely an optimization; never fail a run
+            # over it.
+            pass
+
+    def invalidate_cached_card(self, card_id):
+        try:
+            os.remove(self.card_cache_path(card_id))
+        except OSError:
+            pass
+
+    @check_trello_tokens
+    async def get_card(self, card_id):
+        url = card_api_url_tmpl.format(card_id)
+        params = dict(self.trello_auth_params, fields=card_fields)
+
+        # Repeated fetches of the same card (retries, interactive
+        # debugging) become conditional requests: a 304 carries no body
+        # and we reuse the cached fields.
+        etag, cached = self.load_cached_card(card_id)
+        headers = {}
+
+        if etag and cached:
+            headers['If-None-Match'] = etag
+
+        resp = await self.client.get(url, params=params, headers=headers)
+
+        if resp.status_code == 304:
+            data = cached
+        else:
+            resp.raise_for_status()
+            data = orjson.loads(resp.content)
+            resp_etag = resp.headers.get('ETag')
+
+            if resp_etag:
+                self.store_cached_card(card_id, resp_etag, data)
+
+        return Card(data['name'], data['desc'], data['shortUrl'])
+
+    @check_trello_tokens
+    async def set_card_description(self, card_id, description):
+        url = card_api_url_tmpl.format(card_id)
+        params = dict(self.trello_auth_params, desc=description)
+
+        resp = await self.client.put(url, params=params)
+        resp.raise_for_status()
+        self.invalidate_cached_card(card_id)
+
+    async def get_current_user(self):
         print('Querying current user...')
         url = bz_whoami_api_url_tmpl.format(self.bugzilla_url_base)
 
-        request = Request(
-            url=url,
-            headers=self.bugzilla_auth_request_headers,
-            method='GET',
-        )
+        resp = await self.client.get(
+            url, headers=self.bugzilla_auth_request_headers)
 
-        try:
-            with urlopen(request) as f:
-                response = json.loads(f.read().decode('utf8'))
-        except HTTPError as e:
-            error = get_bugzilla_error(e)
+        if resp.status_code >= 400:
+            error = get_bugzilla_error(resp.content)
             print('Error querying current user on Bugzilla: {}'.format(error))
             return None
 
+        response = orjson.loads(resp.content)
         return response['name']
 
-    def file_trello_bug(self, card, assign_bug):
+    async def file_trello_bug(self, card, current_user=None):
         card_name = card.name
         m = story_name_with_points.match(card_name)
 
@@ -207,43 +384,30 @@ class TrelloBug(object):
 
         url = bug_api_url_tmpl.format(self.bugzilla_url_base)
 
-        bug_data = {
-            'product': self.bz_product,
-            'component': self.bz_component,
-            'version': self.bz_version,
-            'summary': card_name,
-            'description': card.description,
-            'url': card.short_url,
-            'op_sys': 'Unspecified',
-            'platform': 'Unspecified',
-        }
-
-        if assign_bug:
-            current_user = self.get_current_user()
-
-            if not current_user:
-                return None
+        bug_data = dict(
+            self._base_bug_data,
+            summary=card_name,
+            description=card.description,
+            url=card.short_url,
+        )
 
+        if current_user:
             bug_data['status'] = 'ASSIGNED'
             bug_data['assigned_to'] = current_user
 
-        request = Request(
-            url=url,
-            data=json.dumps(bug_data).encode('utf8'),
-            headers=self.bugzilla_auth_request_headers,
-            method='POST',
-        )
-
         print('Filing bug...')
 
-        try:
-            with urlopen(request) as f:
-                response = json.loads(f.read().decode('utf8'))
-        except HTTPError as e:
-            error = get_bugzilla_error(e)
+        resp = await self.client.post(
+            url, content=orjson.dumps(bug_data),
+            headers=self.bugzilla_auth_request_headers)
+
+        if resp.status_code >= 400:
+            error = get_bugzilla_error(resp.content)
             print('Error filing bug in Bugzilla: {}'.format(error))
             return None
 
+        response = orjson.loads(resp.content)
+
         bug = {
             'id': response['id'],
             'url': bug_url_tmpl.format(self.bugzilla_url_base, response['id']),
@@ -252,17 +416,32 @@ class TrelloBug(object):
 
         return bug
 
+    def config_digest(self):
+        buf = io.StringIO()
+        self.config.write(buf)
+        return hashlib.sha256(buf.getvalue().encode('utf8')).digest()
+
     def write_config(self):
         print('Saving changes to {}.'.format(self.config_file))
 
-        with open(self.config_file, 'w') as f:
+        def opener(path, flags):
+            # The config file holds API keys and OAuth secrets, so
+            # don't create it world-readable.
+            return os.open(path, flags, 0o600)
+
+        # Write to a temp file and rename into place so a failure
+        # mid-write can't leave a truncated config behind.
+        tmp_file = self.config_file + '.tmp'
+
+        with open(tmp_file, 'w', opener=opener) as f:
             self.config.write(f)
 
+        os.replace(tmp_file, self.config_file)
+
         print()
 
     def load_config(self):
-        self.config = configparser.ConfigParser()
-        self.config.read(self.config_file)
+        self.config = parse_config(self.config_file)
 
         if 'bugzilla' not in self.config:
             self.config.add_section('bugzilla')
@@ -277,22 +456,25 @@ class TrelloBug(object):
             print('Using the Bugzilla instance at {}'.format(
                 DEFAULT_BUGZILLA_URL))
 
-        changed = False
+        # Compare serialized digests rather than tracking a changed
+        # flag, so re-entering an identical value doesn't trigger a
+        # rewrite.
+        digest = self.config_digest()
 
-        changed |= self.query_option(
+        self.query_option(
             'bugzilla', 'api_key', 'Bugzilla API key',
             'Please visit '
             'https://bugzilla.mozilla.org/userprefs.cgi?tab=apikey '
             'to see your existing API keys or to generate a new one.'
         )
 
-        changed |= self.query_option(
+        self.query_option(
             'trello', 'api_key', 'Trello API key',
             'You can see your API key at '
             'https://trello.com/1/appKey/generate in the top box.'
         )
 
-        changed |= self.query_option(
+        self.query_option(
             'trello', 'api_secret', 'Trello API secret',
             'You can see your API secret at https://trello.com/app-key at the '
             'bottom under "OAuth".'
@@ -301,9 +483,11 @@ class TrelloBug(object):
         if ('oauth_token' not in self.trello_config or
                 'oauth_token_secret' not in self.trello_config):
             self.generate_trello_oauth_tokens()
-            changed = True
+        elif self.trello_tokens_expiring_soon():
+            print('Trello OAuth token is about to expire.')
+            self.generate_trello_oauth_tokens()
 
-        if changed:
+        if self.config_digest() != digest:
             self.write_config()
 
 
@@ -312,9 +496,9 @@ def main():
     import sys
 
     parser = argparse.ArgumentParser(
-        description='File a bug based on a Trello card.'
+        description='File bugs based on Trello cards.'
     )
-    parser.add_argument('card_id_or_url')
+    parser.add_argument('card_id_or_url', nargs='+')
     parser.add_argument(
         '--config',
         help='Specify config file to load',
@@ -322,42 +506,47 @@ def main():
     parser.add_argument(
         '--assign',
         action='store_true',
-        help='Assign bug to self'
+        help='Assign bugs to self'
     )
     parser.add_argument(
         '--product',
-        help='Bugzilla product in which to file bug; overrides config file',
+        help='Bugzilla product in which to file bugs; overrides config file',
     )
     parser.add_argument(
         '--component',
-        help='Bugzilla component in which to file bug; overrides config file',
+        help='Bugzilla component in which to file bugs; overrides config '
+        'file',
     )
     parser.add_argument(
         '--version',
-        help='Value for the version field of the new bug; overrides config '
+        help='Value for the version field of new bugs; overrides config '
         'file',
     )
     args = parser.parse_args()
 
-    if '/' in args.card_id_or_url:
-        m = card_path.match(urlparse(args.card_id_or_url).path)
-        if not m:
-            print('"{}" does not contain a valid card path.')
-            sys.exit(1)
+    card_ids = []
 
-        card_id = m.group(1)
-    else:
-        card_id = args.card_id_or_url
+    for card_id_or_url in args.card_id_or_url:
+        if '/' in card_id_or_url:
+            m = card_path.match(urlparse(card_id_or_url).path)
+            if not m:
+                print('"{}" does not contain a valid card path.'.format(
+                    card_id_or_url))
+                sys.exit(1)
+
+            card_ids.append(m.group(1))
+        else:
+            card_ids.append(card_id_or_url)
 
     config_file = args.config
 
     if config_file is None:
         print('Looking for config file...')
-        for f in DEFAULT_CONFIG_FILES:
-            if os.path.exists(f):
-                config_file = f
-                print('Found config file: {}.'.format(config_file))
-                break
+        config_file = next(
+            (f for f in DEFAULT_CONFIG_FILES if os.path.exists(f)), None)
+
+        if config_file is not None:
+            print('Found config file: {}.'.format(config_file))
         else:
             config_file = DEFAULT_CONFIG_FILES[0]
             print('No config file found; using default: {}'.format(
@@ -365,7 +554,7 @@ def main():
 
     trello_to_bug = TrelloBug(config_file, args.product, args.component,
                               args.version)
-    success = trello_to_bug.trello_to_bug(card_id, args.assign)
+    success = asyncio.run(trello_to_bug.run(card_ids, args.assign))
     rc = 0 if success else 1
     sys.exit(rc)
 